@@ -1,31 +1,46 @@
 # lulu_advanced_analytics_dashboard.py
 # Advanced Streamlit dashboard for Lulu UAE sales & ad performance analysis
 # Usage:
-#   pip install streamlit pandas numpy altair
+#   pip install streamlit pandas numpy altair polars pyarrow
 #   streamlit run lulu_advanced_analytics_dashboard.py
 
 import streamlit as st
 import pandas as pd
 import numpy as np
-import altair as alt
+import io
+import polars as pl
 from pathlib import Path
-from datetime import datetime
 
 st.set_page_config(page_title="Lulu UAE — Advanced Analytics", layout="wide")
-alt.data_transformers.enable('default', max_rows=50000)
+
+AGE_BINS = [-np.inf, 18, 25, 35, 45, 55, 65, np.inf]
+AGE_GROUPS = ['13-17', '18-24', '25-34', '35-44', '45-54', '55-64', '65+']
 
 # ===== HELPERS =====
-def load_csv_safe(path):
-    p = Path(path)
-    if not p.exists():
-        return None
-    try:
-        return pd.read_csv(p)
-    except Exception:
+@st.cache_resource
+def get_altair():
+    # Imported and configured once per process, when a page first draws a chart
+    import altair as alt
+    alt.data_transformers.enable('default', max_rows=50000)
+    return alt
+
+def load_csv_safe(source, **read_kw):
+    # source is either a file path or the raw bytes of an uploaded CSV
+    if isinstance(source, bytes):
+        open_src = lambda: io.BytesIO(source)
+    else:
+        p = Path(source)
+        if not p.exists():
+            return None
+        open_src = lambda: p
+    # Multithreaded pyarrow parser first; the C and python engines cover files
+    # and options (e.g. nrows) it doesn't support
+    for engine in ("pyarrow", "c", "python"):
         try:
-            return pd.read_csv(p, engine="python")
+            return pd.read_csv(open_src(), engine=engine, **read_kw)
         except Exception:
-            return None
+            continue
+    return None
 
 def detect_columns(df):
     cols = df.columns.tolist()
@@ -71,18 +86,23 @@ def prepare_dataframe(df, mapping):
     if mapping.get('date'): ren[mapping['date']] = 'Date'
     d = d.rename(columns=ren)
 
+    # SalesAmount stays float64: float32 sums drift visibly on large totals
     if 'SalesAmount' in d.columns:
         d['SalesAmount'] = pd.to_numeric(d['SalesAmount'], errors='coerce').fillna(0.0)
     else:
         d['SalesAmount'] = 1.0
     if 'Quantity' in d.columns:
-        d['Quantity'] = pd.to_numeric(d['Quantity'], errors='coerce').fillna(1)
+        qty = pd.to_numeric(d['Quantity'], errors='coerce').fillna(1)
+        # Keep fractional quantities (e.g. weighed goods) rather than truncating them
+        d['Quantity'] = qty.astype(np.int32) if (qty % 1 == 0).all() else qty.astype(np.float32)
     else:
-        d['Quantity'] = 1
+        d['Quantity'] = np.ones(len(d), dtype=np.int32)
     if 'Transaction' not in d.columns:
         d['Transaction'] = d.index.astype(str)
     else:
         d['Transaction'] = d['Transaction'].astype(str)
+    # Categorical ids let nunique and groupbys count integer codes instead of hashing strings
+    d['Transaction'] = d['Transaction'].astype('category')
 
     # Handle Age
     if 'Age' in d.columns:
@@ -90,59 +110,137 @@ def prepare_dataframe(df, mapping):
     else:
         d['Age'] = np.random.randint(18, 65, size=len(d))
 
-    # Create Age Groups
-    def age_group(age):
-        if pd.isna(age): return 'Unknown'
-        if age < 18: return '13-17'
-        elif age < 25: return '18-24'
-        elif age < 35: return '25-34'
-        elif age < 45: return '35-44'
-        elif age < 55: return '45-54'
-        elif age < 65: return '55-64'
-        else: return '65+'
-    
-    d['AgeGroup'] = d['Age'].apply(age_group)
+    # Create Age Groups (ordered categorical, 'Unknown' for missing ages)
+    d['AgeGroup'] = pd.cut(d['Age'], bins=AGE_BINS, right=False, labels=AGE_GROUPS)
+    d['AgeGroup'] = d['AgeGroup'].cat.add_categories('Unknown').fillna('Unknown')
 
     text_cols = ['Department','Store_format','Category','Product','Campaign','PromoCode','Gender','Nationality','City']
-    for c in text_cols:
-        if c in d.columns:
-            d[c] = d[c].fillna('Unknown').astype(str)
+    present = [c for c in text_cols if c in d.columns]
+    d[present] = d[present].fillna('Unknown').astype(str)
+    # Low-cardinality labels become categoricals so filters/groupbys work on integer codes
+    d = d.astype({c: 'category' for c in present if c != 'Product'})
 
     if 'Date' in d.columns:
-        d['Date'] = pd.to_datetime(d['Date'], errors='coerce')
+        # Already datetime64 when parse_dates succeeded at read time
+        if not pd.api.types.is_datetime64_dtype(d['Date']):
+            d['Date'] = pd.to_datetime(d['Date'], errors='coerce')
     else:
         d['Date'] = pd.Timestamp.now()
 
     if 'PromoCode' in d.columns:
-        d['PromoUsed'] = d['PromoCode'].astype(str).str.strip().replace({'nan':'','None':''}).apply(lambda x: bool(x) and x!='')
+        # Missing codes were filled with 'Unknown' above and do not count as a promo
+        promo = d['PromoCode'].astype('string').str.strip()
+        d['PromoUsed'] = ((promo != '') & ~promo.str.lower().isin(['nan', 'none', 'unknown'])).astype(bool)
     else:
         d['PromoUsed'] = False
 
     if 'Campaign' in d.columns:
-        d['CampaignActive'] = d['Campaign'].astype(str).str.strip() != 'Unknown'
+        d['CampaignActive'] = (d['Campaign'].astype(str).str.strip() != 'Unknown').astype(bool)
     else:
         d['CampaignActive'] = False
 
     return d
 
+def filter_mask(df, city, store, date_range):
+    # Boolean numpy mask built from categorical codes and int64 dates
+    mask = np.ones(len(df), dtype=bool)
+    if city != 'All':
+        city_code = df['City'].cat.categories.get_loc(city)
+        np.logical_and(mask, df['City'].cat.codes.to_numpy() == city_code, out=mask)
+    if store != 'All':
+        store_code = df['Store_format'].cat.categories.get_loc(store)
+        np.logical_and(mask, df['Store_format'].cat.codes.to_numpy() == store_code, out=mask)
+    if date_range:
+        dates = df['Date'].to_numpy()
+        date_i8 = dates.view('i8')
+        start = np.datetime64(pd.to_datetime(date_range[0])).astype(dates.dtype).view('i8')
+        end = np.datetime64(pd.to_datetime(date_range[1])).astype(dates.dtype).view('i8')
+        np.logical_and(mask, (date_i8 >= start) & (date_i8 <= end), out=mask)
+    return mask
+
+def chart_data(frame, *cols):
+    # Only the columns a chart encodes, with categorical labels as plain strings,
+    # to keep the payload sent to Vega-Lite small
+    out = frame[list(cols)].copy()
+    for c in cols:
+        if isinstance(out[c].dtype, pd.CategoricalDtype):
+            out[c] = out[c].astype(str)
+    return out
+
+@st.cache_resource(max_entries=2, show_spinner="Loading data…")
+def load_and_prepare(source_key, _source):
+    # Cached so widget interactions don't re-parse and re-prepare the CSV on every rerun.
+    # A shared (not copied per rerun) resource, treated as read-only. Keyed on the short
+    # source_key only; _source (a path or an UploadedFile) is not hashed.
+    source = _source if isinstance(_source, str) else _source.getvalue()
+    # Map columns from the header alone, then parse the whole file (unmapped columns
+    # such as Payment_Method stay in the export), converting the date column while reading
+    header = load_csv_safe(source, nrows=0)
+    if header is None:
+        # Raised rather than returned so a failed load is not cached
+        raise ValueError("Could not load CSV")
+    mapping = detect_columns(header)
+    parse_dates = [mapping['date']] if mapping.get('date') else None
+    raw = load_csv_safe(source, parse_dates=parse_dates, cache_dates=True)
+    if raw is None:
+        raise ValueError("Could not load CSV")
+    return prepare_dataframe(raw, mapping)
+
+@st.cache_resource(max_entries=2)
+def load_polars(source_key, _df):
+    # Arrow-backed copy of the prepared data for the multi-column groupby pages
+    return pl.from_pandas(_df)
+
+@st.cache_resource(max_entries=4)
+def apply_filters(source_key, filter_key, _df):
+    # Filtered rows (pandas and Polars) per filter_key = (city, store, date_range), shared
+    # across reruns and page switches without copying; callers treat them as read-only.
+    # source_key is part of the key, so a re-uploaded file never reuses a stale slice.
+    # Each entry holds two copies of the selected rows, hence the small bound.
+    mask = filter_mask(_df, *filter_key)
+    pdf = load_polars(source_key, _df)
+    if mask.all():
+        # Nothing filtered out: hand back the cached frames themselves
+        return _df, pdf
+    return _df.iloc[np.flatnonzero(mask)], pdf.filter(mask)
+
+@st.cache_data
+def option_list(source_key, col, _df):
+    # Selectbox options read from the categorical's categories instead of scanning the column
+    cats = _df[col].cat.categories.tolist()
+    return ['All'] + sorted(c for c in cats if c != 'Unknown')
+
+@st.cache_data(max_entries=32)
+def agg_by(source_key, keys, filter_key, _filtered):
+    # Sales summary per `keys` over the filtered rows. Cached on (source_key, filter_key), which
+    # determine _filtered, so repeated page visits with unchanged filters skip the groupby.
+    return _filtered.groupby(list(keys), observed=True).agg(
+        TotalSales=('SalesAmount', 'sum'),
+        Transactions=('Transaction', 'nunique'),
+        AvgBasket=('SalesAmount', 'mean'),
+        WithPromo=('PromoUsed', 'sum'),
+        PromoRate=('PromoUsed', 'mean')
+    ).reset_index()
+
 # ===== LOAD DATA =====
 DEFAULT_PATH = "/mnt/data/lulu_uae_master_2000.csv"
-raw = load_csv_safe(DEFAULT_PATH)
+source, source_key = DEFAULT_PATH, DEFAULT_PATH
 
 st.sidebar.header("📁 Data Management")
 use_upload = st.sidebar.checkbox("Upload CSV", value=False)
 if use_upload:
     uploaded = st.sidebar.file_uploader("Upload transactions CSV", type=["csv"])
     if uploaded is not None:
-        raw = pd.read_csv(uploaded)
+        # Cache on the upload's id rather than hashing its bytes on every cached call;
+        # only the loader reads the file contents
+        source, source_key = uploaded, f"upload:{uploaded.file_id}"
 
-if raw is None:
+try:
+    df = load_and_prepare(source_key, source)
+except ValueError:
     st.error(f"Could not load CSV. Please upload a file.")
     st.stop()
 
-mapping = detect_columns(raw)
-df = prepare_dataframe(raw, mapping)
-
 # ===== SIDEBAR NAVIGATION & FILTERS =====
 st.sidebar.header("🎯 Navigation & Filters")
 
@@ -157,11 +255,9 @@ page = st.sidebar.radio("Select Page", [
 # Global Filters
 st.sidebar.subheader("Global Filters")
 
-city_values = ['All'] + sorted([c for c in df['City'].unique() if c != 'Unknown'])
-selected_city = st.sidebar.selectbox("🏙️ City", city_values)
+selected_city = st.sidebar.selectbox("🏙️ City", option_list(source_key, 'City', df))
 
-store_values = ['All'] + sorted([s for s in df['Store_format'].unique() if s != 'Unknown'])
-selected_store = st.sidebar.selectbox("🏬 Store Type", store_values)
+selected_store = st.sidebar.selectbox("🏬 Store Type", option_list(source_key, 'Store_format', df))
 
 if 'Date' in df.columns and df['Date'].notna().any():
     min_d = df['Date'].min().date()
@@ -171,25 +267,24 @@ else:
     date_range = None
 
 # Apply Filters
-mask = pd.Series(True, index=df.index)
-if selected_city != 'All':
-    mask &= (df['City'] == selected_city)
-if selected_store != 'All':
-    mask &= (df['Store_format'] == selected_store)
-if date_range:
-    start, end = pd.to_datetime(date_range[0]), pd.to_datetime(date_range[1])
-    mask &= (df['Date'] >= start) & (df['Date'] <= end)
+filter_key = (selected_city, selected_store, tuple(date_range) if date_range else None)
+filtered, pfiltered = apply_filters(source_key, filter_key, df)
 
-filtered = df[mask].copy()
+# ===== PAGES =====
+# Each page is a fragment: interacting with a page's own widgets reruns only that page,
+# not the data loading, filtering and sidebar above
 
 # ===== PAGE: OVERVIEW =====
-if page == "📊 Overview":
+@st.fragment
+def render_overview(filtered, pfiltered):
+    alt = get_altair()
     st.title("📊 Lulu UAE — Sales Overview")
     
     col1, col2, col3, col4 = st.columns(4)
     total_sales = filtered['SalesAmount'].sum()
     total_tx = filtered['Transaction'].nunique()
-    avg_basket = filtered.groupby('Transaction')['SalesAmount'].sum().mean() if total_tx > 0 else 0
+    # Mean of per-transaction totals == total sales / distinct transactions, multi-line baskets included
+    avg_basket = total_sales / total_tx if total_tx > 0 else 0
     total_qty = filtered['Quantity'].sum()
     
     col1.metric("💰 Total Sales", f"AED {total_sales:,.0f}")
@@ -199,15 +294,23 @@ if page == "📊 Overview":
     
     st.divider()
     
+    # City and store breakdowns are collected together over one scan
+    lf = pfiltered.lazy()
+    sales_aggs = [
+        pl.col('SalesAmount').sum().alias('TotalSales'),
+        pl.col('Transaction').n_unique().alias('Transactions')
+    ]
+    lf_city = lf.group_by('City').agg(sales_aggs).sort('TotalSales', descending=True)
+    lf_store = lf.group_by('Store_format').agg(sales_aggs).sort('TotalSales', descending=True)
+    city_df, store_df = [
+        f.with_columns((pl.col('TotalSales') / pl.col('Transactions')).alias('AvgBasket')).to_pandas()
+        for f in pl.collect_all([lf_city, lf_store])
+    ]
+    
     # City Analysis
     st.subheader("🏙️ Sales by City")
-    city_df = filtered.groupby('City').agg(
-        TotalSales=('SalesAmount', 'sum'),
-        Transactions=('Transaction', 'nunique')
-    ).reset_index().sort_values('TotalSales', ascending=False)
-    city_df['AvgBasket'] = city_df['TotalSales'] / city_df['Transactions']
     
-    chart_city = alt.Chart(city_df).mark_bar().encode(
+    chart_city = alt.Chart(chart_data(city_df, 'City', 'TotalSales', 'Transactions', 'AvgBasket')).mark_bar().encode(
         x=alt.X('City:N', sort='-y'),
         y='TotalSales:Q',
         color='TotalSales:Q',
@@ -217,13 +320,7 @@ if page == "📊 Overview":
     
     # Store Type Analysis
     st.subheader("🏬 Sales by Store Type")
-    store_df = filtered.groupby('Store_format').agg(
-        TotalSales=('SalesAmount', 'sum'),
-        Transactions=('Transaction', 'nunique')
-    ).reset_index().sort_values('TotalSales', ascending=False)
-    store_df['AvgBasket'] = store_df['TotalSales'] / store_df['Transactions']
-    
-    chart_store = alt.Chart(store_df).mark_bar().encode(
+    chart_store = alt.Chart(chart_data(store_df, 'Store_format', 'TotalSales', 'Transactions')).mark_bar().encode(
         x=alt.X('Store_format:N', sort='-y'),
         y='TotalSales:Q',
         color='TotalSales:Q',
@@ -232,7 +329,9 @@ if page == "📊 Overview":
     st.altair_chart(chart_store, use_container_width=True)
 
 # ===== PAGE: CUSTOMER PERSONAS =====
-elif page == "👥 Customer Personas":
+@st.fragment
+def render_personas(filtered, pfiltered):
+    alt = get_altair()
     st.title("👥 Customer Personas by Age Group")
     st.write("Analyze purchasing behavior across age groups to identify target demographics.")
     
@@ -240,32 +339,59 @@ elif page == "👥 Customer Personas":
     
     # Age Group Distribution
     st.subheader("📊 Customer Distribution by Age Group")
-    age_dist = filtered['AgeGroup'].value_counts().reset_index().rename(columns={'index': 'AgeGroup', 'AgeGroup': 'Count'})
-    age_dist = age_dist.sort_values('AgeGroup')
+    # Rendered below, once all persona aggregations have been collected
+    age_chart_slot = st.empty()
+    
+    st.divider()
+    
+    # Age Group Selection
+    selected_age_group = st.selectbox("Select Age Group to Analyze", ['All'] + filtered['AgeGroup'].cat.categories.tolist())
+    
+    # All four persona aggregations are collected together over one scan
+    lf = pfiltered.lazy()
+    lf_agedist = lf.group_by('AgeGroup').agg(pl.len().alias('Count'))
+    
+    lf_age = lf if selected_age_group == 'All' else lf.filter(pl.col('AgeGroup') == selected_age_group)
+    lf_catage = lf_age.group_by('Category').agg([
+        pl.col('SalesAmount').sum().alias('TotalSales'),
+        pl.col('Transaction').n_unique().alias('Transactions'),
+        pl.col('Quantity').mean().alias('AvgQty')
+    ]).top_k(15, by=['TotalSales', pl.col('Category').cast(pl.String)], reverse=[False, True])
+    
+    lf_topcats = lf.group_by('Category').agg(pl.col('SalesAmount').sum()).top_k(
+        10, by=['SalesAmount', pl.col('Category').cast(pl.String)], reverse=[False, True]
+    ).select('Category')
+    lf_heatmap = lf.join(lf_topcats, on='Category', how='semi').group_by(['AgeGroup', 'Category']).agg(
+        pl.col('SalesAmount').sum().alias('TotalSales')
+    )
     
-    chart_age = alt.Chart(age_dist).mark_bar().encode(
-        x=alt.X('AgeGroup:N', sort=['13-17', '18-24', '25-34', '35-44', '45-54', '55-64', '65+']),
+    # Most bought category per age group from an (AgeGroup, Category) count table:
+    # highest count wins, ties go to the first category label, so reruns agree
+    lf_mostbought = lf.group_by(['AgeGroup', 'Category']).agg(pl.len().alias('n')).group_by('AgeGroup').agg(
+        pl.col('Category').sort_by(['n', pl.col('Category').cast(pl.String)], descending=[True, False]).first().alias('MostBought')
+    )
+    lf_personastats = lf.group_by('AgeGroup').agg([
+        pl.col('SalesAmount').sum().alias('TotalSales'),
+        pl.col('SalesAmount').mean().alias('AvgTransaction'),
+        pl.col('Quantity').mean().alias('AvgQty'),
+        pl.col('Transaction').n_unique().alias('UniqueCustomers')
+    ]).join(lf_mostbought, on='AgeGroup').sort('AgeGroup')
+    
+    age_dist, cat_age, heatmap_data, persona_stats = [
+        f.to_pandas() for f in pl.collect_all([lf_agedist, lf_catage, lf_heatmap, lf_personastats])
+    ]
+    
+    chart_age = alt.Chart(chart_data(age_dist, 'AgeGroup', 'Count')).mark_bar().encode(
+        x=alt.X('AgeGroup:N', sort=AGE_GROUPS),
         y='Count:Q',
         color='Count:Q',
         tooltip=['AgeGroup', 'Count:Q']
     ).properties(width=800, height=400).interactive()
-    st.altair_chart(chart_age, use_container_width=True)
-    
-    st.divider()
-    
-    # Age Group Selection
-    selected_age_group = st.selectbox("Select Age Group to Analyze", ['All'] + sorted(filtered['AgeGroup'].unique()))
-    age_filtered = filtered if selected_age_group == 'All' else filtered[filtered['AgeGroup'] == selected_age_group]
+    age_chart_slot.altair_chart(chart_age, use_container_width=True)
     
     st.subheader(f"🛍️ Top Categories for {selected_age_group}")
     
-    cat_age = age_filtered.groupby('Category').agg(
-        TotalSales=('SalesAmount', 'sum'),
-        Transactions=('Transaction', 'nunique'),
-        AvgQty=('Quantity', 'mean')
-    ).reset_index().sort_values('TotalSales', ascending=False).head(15)
-    
-    chart_cat = alt.Chart(cat_age).mark_bar().encode(
+    chart_cat = alt.Chart(chart_data(cat_age, 'Category', 'TotalSales', 'Transactions', 'AvgQty')).mark_bar().encode(
         x=alt.X('Category:N', sort='-y'),
         y='TotalSales:Q',
         color='TotalSales:Q',
@@ -277,14 +403,9 @@ elif page == "👥 Customer Personas":
     
     # Heatmap: Age Group vs Category
     st.subheader("🔥 Heatmap: Age Group vs Top Categories")
-    top_cats = filtered.groupby('Category')['SalesAmount'].sum().nlargest(10).index
-    heatmap_data = filtered[filtered['Category'].isin(top_cats)].groupby(['AgeGroup', 'Category']).agg(
-        TotalSales=('SalesAmount', 'sum')
-    ).reset_index()
-    
-    heatmap = alt.Chart(heatmap_data).mark_rect().encode(
+    heatmap = alt.Chart(chart_data(heatmap_data, 'AgeGroup', 'Category', 'TotalSales')).mark_rect().encode(
         x=alt.X('Category:N'),
-        y=alt.Y('AgeGroup:N', sort=['13-17', '18-24', '25-34', '35-44', '45-54', '55-64', '65+']),
+        y=alt.Y('AgeGroup:N', sort=AGE_GROUPS),
         color='TotalSales:Q',
         tooltip=['AgeGroup', 'Category', 'TotalSales:Q']
     ).properties(width=900, height=400).interactive()
@@ -294,18 +415,12 @@ elif page == "👥 Customer Personas":
     
     # Summary Statistics
     st.subheader("📈 Persona Summary Statistics")
-    persona_stats = filtered.groupby('AgeGroup').agg(
-        TotalSales=('SalesAmount', 'sum'),
-        AvgTransaction=('SalesAmount', 'mean'),
-        AvgQty=('Quantity', 'mean'),
-        UniqueCustomers=('Transaction', 'nunique'),
-        MostBought=('Category', lambda x: x.value_counts().index[0] if len(x) > 0 else 'N/A')
-    ).reset_index().sort_values('AgeGroup')
-    
     st.dataframe(persona_stats, use_container_width=True)
 
 # ===== PAGE: AD CAMPAIGN ANALYSIS =====
-elif page == "📢 Ad Campaign Analysis":
+@st.fragment
+def render_campaigns(filtered, source_key, filter_key):
+    alt = get_altair()
     st.title("📢 Ad Campaign Performance Analysis")
     st.write("Analyze campaign effectiveness across cities and identify winning strategies.")
     
@@ -313,17 +428,11 @@ elif page == "📢 Ad Campaign Analysis":
     
     # Overall Campaign Performance
     st.subheader("📊 Overall Campaign Performance")
-    campaign_perf = filtered.groupby('Campaign').agg(
-        TotalSales=('SalesAmount', 'sum'),
-        Transactions=('Transaction', 'nunique'),
-        AvgBasket=('SalesAmount', 'mean'),
-        WithPromo=('PromoUsed', 'sum'),
-        PromoRate=('PromoUsed', 'mean')
-    ).reset_index().sort_values('TotalSales', ascending=False)
+    campaign_perf = agg_by(source_key, ('Campaign',), filter_key, filtered).sort_values('TotalSales', ascending=False)
     
     campaign_perf['ROIScore'] = (campaign_perf['TotalSales'] / campaign_perf['Transactions']).round(2)
     
-    chart_camp = alt.Chart(campaign_perf).mark_bar().encode(
+    chart_camp = alt.Chart(chart_data(campaign_perf, 'Campaign', 'TotalSales', 'ROIScore', 'Transactions', 'AvgBasket', 'PromoRate')).mark_bar().encode(
         x=alt.X('Campaign:N', sort='-y'),
         y='TotalSales:Q',
         color='ROIScore:Q',
@@ -337,17 +446,15 @@ elif page == "📢 Ad Campaign Analysis":
     
     # Campaign Performance by City
     st.subheader("🏙️ Campaign Performance by City")
-    selected_campaign = st.selectbox("Select Campaign to Analyze", ['All'] + sorted([c for c in filtered['Campaign'].unique() if c != 'Unknown']))
+    # Only campaigns present under the current filters; unique() on the categorical works on codes
+    selected_campaign = st.selectbox("Select Campaign to Analyze", ['All'] + sorted(c for c in filtered['Campaign'].unique() if c != 'Unknown'))
     
-    camp_filtered = filtered if selected_campaign == 'All' else filtered[filtered['Campaign'] == selected_campaign]
+    camp_city = agg_by(source_key, ('City', 'Campaign'), filter_key, filtered)
+    if selected_campaign != 'All':
+        camp_city = camp_city[camp_city['Campaign'] == selected_campaign]
+    camp_city = camp_city[['City', 'Campaign', 'TotalSales', 'Transactions', 'AvgBasket']].sort_values('TotalSales', ascending=False)
     
-    camp_city = camp_filtered.groupby(['City', 'Campaign']).agg(
-        TotalSales=('SalesAmount', 'sum'),
-        Transactions=('Transaction', 'nunique'),
-        AvgBasket=('SalesAmount', 'mean')
-    ).reset_index().sort_values('TotalSales', ascending=False)
-    
-    chart_camp_city = alt.Chart(camp_city).mark_bar().encode(
+    chart_camp_city = alt.Chart(chart_data(camp_city, 'City', 'Campaign', 'TotalSales', 'Transactions', 'AvgBasket')).mark_bar().encode(
         x=alt.X('City:N', sort='-y'),
         y='TotalSales:Q',
         color='Campaign:N',
@@ -359,12 +466,15 @@ elif page == "📢 Ad Campaign Analysis":
     
     # Campaign Effectiveness: Promo vs Non-Promo
     st.subheader("💡 Why Campaigns Work or Fail")
-    camp_analysis = filtered.groupby('Campaign').agg(
-        PromoRate=('PromoUsed', 'mean'),
-        AvgSalesWithPromo=('SalesAmount', 'mean'),
-        TransactionCount=('Transaction', 'nunique'),
-        TopCategory=('Category', lambda x: x.value_counts().index[0] if len(x) > 0 else 'N/A')
-    ).reset_index()
+    camp_analysis = agg_by(source_key, ('Campaign',), filter_key, filtered)[['Campaign', 'PromoRate', 'AvgBasket', 'Transactions']].rename(
+        columns={'AvgBasket': 'AvgSalesWithPromo', 'Transactions': 'TransactionCount'}
+    )
+    # Most frequent category per campaign from one (Campaign, Category) count table:
+    # highest count wins, ties go to the first category label (same rule as MostBought)
+    cat_counts = filtered.groupby(['Campaign', 'Category'], observed=True).size().reset_index(name='n')
+    cat_counts = cat_counts.sort_values(['n', 'Category'], ascending=[False, True], kind='stable')
+    top_category = cat_counts.drop_duplicates('Campaign').set_index('Campaign')['Category']
+    camp_analysis = camp_analysis.join(top_category.rename('TopCategory'), on='Campaign')
     
     camp_analysis['Performance'] = camp_analysis['PromoRate'].apply(
         lambda x: '✅ High Engagement' if x > 0.3 else ('⚠️ Medium Engagement' if x > 0.15 else '❌ Low Engagement')
@@ -380,7 +490,9 @@ elif page == "📢 Ad Campaign Analysis":
     """)
 
 # ===== PAGE: CATEGORY TARGETING STRATEGY =====
-elif page == "🎯 Category Targeting Strategy":
+@st.fragment
+def render_category_targeting(filtered, source_key, filter_key):
+    alt = get_altair()
     st.title("🎯 Category Targeting Strategy")
     st.write("Match top categories with best performing age groups and campaigns.")
     
@@ -388,13 +500,10 @@ elif page == "🎯 Category Targeting Strategy":
     
     # Top Categories Overall
     st.subheader("🏆 Top 15 Categories by Sales")
-    top_cats = filtered.groupby('Category').agg(
-        TotalSales=('SalesAmount', 'sum'),
-        Transactions=('Transaction', 'nunique'),
-        AvgBasket=('SalesAmount', 'mean')
-    ).reset_index().sort_values('TotalSales', ascending=False).head(15)
+    top_cats = agg_by(source_key, ('Category',), filter_key, filtered)[['Category', 'TotalSales', 'Transactions', 'AvgBasket']]
+    top_cats = top_cats.nlargest(15, 'TotalSales')
     
-    chart_top_cats = alt.Chart(top_cats).mark_bar().encode(
+    chart_top_cats = alt.Chart(chart_data(top_cats, 'Category', 'TotalSales', 'Transactions', 'AvgBasket')).mark_bar().encode(
         x=alt.X('Category:N', sort='-y'),
         y='TotalSales:Q',
         color='TotalSales:Q',
@@ -418,13 +527,11 @@ elif page == "🎯 Category Targeting Strategy":
     
     # Age Group Performance for Selected Category
     st.subheader(f"📊 {selected_cat} - Sales by Age Group")
-    cat_age_sales = cat_data.groupby('AgeGroup').agg(
-        TotalSales=('SalesAmount', 'sum'),
-        Transactions=('Transaction', 'nunique'),
-        AvgBasket=('SalesAmount', 'mean')
-    ).reset_index().sort_values('TotalSales', ascending=False)
+    cat_age_sales = agg_by(source_key, ('Category', 'AgeGroup'), filter_key, filtered)
+    cat_age_sales = cat_age_sales.loc[cat_age_sales['Category'] == selected_cat, ['AgeGroup', 'TotalSales', 'Transactions', 'AvgBasket']]
+    cat_age_sales = cat_age_sales.sort_values('TotalSales', ascending=False)
     
-    chart_cat_age = alt.Chart(cat_age_sales).mark_bar().encode(
+    chart_cat_age = alt.Chart(chart_data(cat_age_sales, 'AgeGroup', 'TotalSales', 'Transactions')).mark_bar().encode(
         x=alt.X('AgeGroup:N'),
         y='TotalSales:Q',
         color='TotalSales:Q',
@@ -436,13 +543,11 @@ elif page == "🎯 Category Targeting Strategy":
     
     # Campaign Performance for Selected Category
     st.subheader(f"📢 {selected_cat} - Campaign Performance")
-    cat_camp_sales = cat_data.groupby('Campaign').agg(
-        TotalSales=('SalesAmount', 'sum'),
-        Transactions=('Transaction', 'nunique'),
-        PromoRate=('PromoUsed', 'mean')
-    ).reset_index().sort_values('TotalSales', ascending=False)
+    cat_camp_sales = agg_by(source_key, ('Category', 'Campaign'), filter_key, filtered)
+    cat_camp_sales = cat_camp_sales.loc[cat_camp_sales['Category'] == selected_cat, ['Campaign', 'TotalSales', 'Transactions', 'PromoRate']]
+    cat_camp_sales = cat_camp_sales.sort_values('TotalSales', ascending=False)
     
-    chart_cat_camp = alt.Chart(cat_camp_sales).mark_bar().encode(
+    chart_cat_camp = alt.Chart(chart_data(cat_camp_sales, 'Campaign', 'TotalSales', 'PromoRate', 'Transactions')).mark_bar().encode(
         x=alt.X('Campaign:N', sort='-y'),
         y='TotalSales:Q',
         color='PromoRate:Q',
@@ -476,7 +581,9 @@ elif page == "🎯 Category Targeting Strategy":
     """)
 
 # ===== PAGE: ADVANCED COMPARISONS =====
-elif page == "📈 Advanced Comparisons":
+@st.fragment
+def render_advanced(filtered, pfiltered):
+    alt = get_altair()
     st.title("📈 Advanced Comparisons & Insights")
     st.write("Multi-dimensional analysis: Age Group × Campaign × Category")
     
@@ -485,14 +592,14 @@ elif page == "📈 Advanced Comparisons":
     # 3D Analysis: Age Group × Campaign × Category
     st.subheader("🔄 Age Group × Campaign Performance")
     
-    age_camp = filtered.groupby(['AgeGroup', 'Campaign']).agg(
-        TotalSales=('SalesAmount', 'sum'),
-        Transactions=('Transaction', 'nunique')
-    ).reset_index()
+    age_camp = pfiltered.group_by(['AgeGroup', 'Campaign']).agg([
+        pl.col('SalesAmount').sum().alias('TotalSales'),
+        pl.col('Transaction').n_unique().alias('Transactions')
+    ]).to_pandas()
     
-    heatmap_ac = alt.Chart(age_camp).mark_rect().encode(
+    heatmap_ac = alt.Chart(chart_data(age_camp, 'AgeGroup', 'Campaign', 'TotalSales', 'Transactions')).mark_rect().encode(
         x=alt.X('Campaign:N'),
-        y=alt.Y('AgeGroup:N', sort=['13-17', '18-24', '25-34', '35-44', '45-54', '55-64', '65+']),
+        y=alt.Y('AgeGroup:N', sort=AGE_GROUPS),
         color='TotalSales:Q',
         tooltip=['AgeGroup', 'Campaign', 'TotalSales:Q', 'Transactions:Q']
     ).properties(width=1000, height=400).interactive()
@@ -503,13 +610,15 @@ elif page == "📈 Advanced Comparisons":
     # Campaign × Category Performance
     st.subheader("🔄 Campaign × Top Categories")
     
-    top_categories = filtered['Category'].value_counts().head(10).index
-    camp_cat = filtered[filtered['Category'].isin(top_categories)].groupby(['Campaign', 'Category']).agg(
-        TotalSales=('SalesAmount', 'sum'),
-        Transactions=('Transaction', 'nunique')
-    ).reset_index().sort_values('TotalSales', ascending=False).head(30)
+    top_categories = filtered['Category'].value_counts(sort=False).nlargest(10).index
+    camp_cat = pfiltered.filter(pl.col('Category').is_in(top_categories.tolist())).group_by(['Campaign', 'Category']).agg([
+        pl.col('SalesAmount').sum().alias('TotalSales'),
+        pl.col('Transaction').n_unique().alias('Transactions')
+    ]).top_k(
+        30, by=['TotalSales', pl.col('Campaign').cast(pl.String), pl.col('Category').cast(pl.String)], reverse=[False, True, True]
+    ).to_pandas()
     
-    chart_cc = alt.Chart(camp_cat).mark_bar().encode(
+    chart_cc = alt.Chart(chart_data(camp_cat, 'Campaign', 'Category', 'TotalSales', 'Transactions')).mark_bar().encode(
         x=alt.X('Campaign:N'),
         y='TotalSales:Q',
         color='Category:N',
@@ -522,14 +631,14 @@ elif page == "📈 Advanced Comparisons":
     # City × Age Group × Sales
     st.subheader("🏙️ City × Age Group Performance")
     
-    city_age = filtered.groupby(['City', 'AgeGroup']).agg(
-        TotalSales=('SalesAmount', 'sum'),
-        Transactions=('Transaction', 'nunique')
-    ).reset_index()
+    city_age = pfiltered.group_by(['City', 'AgeGroup']).agg([
+        pl.col('SalesAmount').sum().alias('TotalSales'),
+        pl.col('Transaction').n_unique().alias('Transactions')
+    ]).to_pandas()
     
-    heatmap_ca = alt.Chart(city_age).mark_rect().encode(
+    heatmap_ca = alt.Chart(chart_data(city_age, 'City', 'AgeGroup', 'TotalSales', 'Transactions')).mark_rect().encode(
         x=alt.X('City:N'),
-        y=alt.Y('AgeGroup:N', sort=['13-17', '18-24', '25-34', '35-44', '45-54', '55-64', '65+']),
+        y=alt.Y('AgeGroup:N', sort=AGE_GROUPS),
         color='TotalSales:Q',
         tooltip=['City', 'AgeGroup', 'TotalSales:Q', 'Transactions:Q']
     ).properties(width=1000, height=400).interactive()
@@ -540,10 +649,18 @@ elif page == "📈 Advanced Comparisons":
     # Performance Insights
     st.subheader("📊 Key Performance Insights")
     
-    top_combo = filtered.groupby(['AgeGroup', 'Campaign', 'Category']).agg(
-        TotalSales=('SalesAmount', 'sum'),
-        Transactions=('Transaction', 'nunique')
-    ).reset_index().sort_values('TotalSales', ascending=False).head(10)
+    # Pick the top 10 by sales first, then count distinct transactions for those combinations only
+    combo_keys = ['AgeGroup', 'Campaign', 'Category']
+    combo_labels = [pl.col(c).cast(pl.String) for c in combo_keys]
+    top_sales = pfiltered.group_by(combo_keys).agg(pl.col('SalesAmount').sum().alias('TotalSales')).top_k(
+        10, by=['TotalSales', *combo_labels], reverse=[False, True, True, True]
+    )
+    top_tx = pfiltered.join(top_sales.select(combo_keys), on=combo_keys, how='semi').group_by(combo_keys).agg(
+        pl.col('Transaction').n_unique().alias('Transactions')
+    )
+    top_combo = top_sales.join(top_tx, on=combo_keys).sort(
+        ['TotalSales', *combo_labels], descending=[True, False, False, False]
+    ).to_pandas()
     
     st.write("**Top 10 Age Group + Campaign + Category Combinations:**")
     st.dataframe(top_combo, use_container_width=True)
@@ -552,12 +669,12 @@ elif page == "📈 Advanced Comparisons":
     
     # Export Summary
     st.subheader("📥 Export Analysis")
-    summary_data = filtered.groupby(['City', 'AgeGroup', 'Campaign', 'Category']).agg(
-        TotalSales=('SalesAmount', 'sum'),
-        Transactions=('Transaction', 'nunique'),
-        AvgBasket=('SalesAmount', 'mean'),
-        PromoRate=('PromoUsed', 'mean')
-    ).reset_index().sort_values('TotalSales', ascending=False)
+    summary_data = pfiltered.group_by(['City', 'AgeGroup', 'Campaign', 'Category']).agg([
+        pl.col('SalesAmount').sum().alias('TotalSales'),
+        pl.col('Transaction').n_unique().alias('Transactions'),
+        pl.col('SalesAmount').mean().alias('AvgBasket'),
+        pl.col('PromoUsed').mean().alias('PromoRate')
+    ]).sort('TotalSales', descending=True).to_pandas()
     
     csv = summary_data.to_csv(index=False)
     st.download_button(
@@ -567,6 +684,18 @@ elif page == "📈 Advanced Comparisons":
         mime="text/csv"
     )
 
+# ===== RENDER SELECTED PAGE =====
+if page == "📊 Overview":
+    render_overview(filtered, pfiltered)
+elif page == "👥 Customer Personas":
+    render_personas(filtered, pfiltered)
+elif page == "📢 Ad Campaign Analysis":
+    render_campaigns(filtered, source_key, filter_key)
+elif page == "🎯 Category Targeting Strategy":
+    render_category_targeting(filtered, source_key, filter_key)
+elif page == "📈 Advanced Comparisons":
+    render_advanced(filtered, pfiltered)
+
 # ===== ADDITIONAL FEATURES - PROMO ANALYSIS PAGE =====
 st.sidebar.divider()
 
@@ -577,7 +706,7 @@ if st.sidebar.button("📊 Generate Full Report"):
     st.sidebar.success("Report generation started!")
     
     report_data = {
-        'Overview': filtered.groupby('City').agg(TotalSales=('SalesAmount', 'sum')).to_dict(),
+        'Overview': filtered.groupby('City', observed=True).agg(TotalSales=('SalesAmount', 'sum')).to_dict(),
         'Demographics': filtered['AgeGroup'].value_counts().to_dict(),
         'Campaigns': filtered['Campaign'].value_counts().to_dict(),
         'Categories': filtered['Category'].value_counts().to_dict()